@@ -10,26 +10,49 @@ __license__ = 'GPLv3'
 __keywords__ = 'notebook laptop power-management sleep suspend energy battery discharge-rate'
 
 import argparse
+import functools
 import logging
+import os
 import re
 import sqlite3
 import sys
 import time
 from pathlib import Path
-from typing import Optional
-
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
+from typing import Iterable, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 DATABASE = f'/usr/local/share/{__pkgname__}/history.db'
 TMPFILE = f'/tmp/{__pkgname__}'
+POWER_SUPPLY_DIR = '/sys/class/power_supply'
 DURATION_THRESHOLD_S = 300
+HEXBIN_THRESHOLD = 2000
 LOGGING_FORMAT = '[%(levelname)s] %(message)s'
+# Matches the active sleep mode in /sys/power/mem_sleep, e.g. "s2idle [deep]"
+MEM_SLEEP_RE = re.compile(r'\[([^\]]+)\]')
 
 sleep_actions = ['suspend', 'hibernate', 'hybrid-sleep', 'suspend-then-hibernate']
 
+# Maps dmidecode string keywords to their attribute names in /sys/class/dmi/id
+dmi_attributes = {
+    'bios-vendor': 'bios_vendor',
+    'bios-version': 'bios_version',
+    'bios-release-date': 'bios_date',
+    'system-manufacturer': 'sys_vendor',
+    'system-product-name': 'product_name',
+    'system-version': 'product_version',
+    'baseboard-manufacturer': 'board_vendor',
+    'baseboard-product-name': 'board_name',
+    'baseboard-version': 'board_version',
+}
+
+# Lookup tables of the categorical session attributes: table, history column, legacy text column
+lookup_tables = [
+    ('bios_versions', 'bios_id', 'bios_version'),
+    ('sleep_modes', 'sleep_mode_id', 'sleep_mode'),
+    ('sleep_actions', 'sleep_action_id', 'sleep_action'),
+]
+
 
 def parse_args() -> argparse.Namespace:
     """
@@ -52,6 +75,7 @@ def parse_args() -> argparse.Namespace:
     parser_plot.add_argument('-b', '--bios', help='filter by BIOS version, e.g. "R1BET66W(1.35 )"')
     parser_plot.add_argument('-m', '--mode', help='filter by sleep mode: deep, s2idle')
     parser_plot.add_argument('-a', '--action', help=f'filter by sleep action: {", ".join(sleep_actions):s}')
+    parser_plot.add_argument('-o', '--output', help='save the plot to a file instead of showing it, e.g. plot.png')
 
     parser.add_argument('-v', '--verbose', help='increase output verbosity',
                         action='store_const', dest='loglevel', const=logging.DEBUG, default=logging.INFO)
@@ -61,27 +85,94 @@ def parse_args() -> argparse.Namespace:
     return result
 
 
+def _read(path: os.PathLike, size: int = 4096) -> str:
+    """
+    Reads a small file, e.g. a sysfs attribute, with a single read syscall, bypassing the buffered io stack.
+    :param path: Filepath of the file
+    :param size: Maximum number of bytes to read
+    :return: Content of the file
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, size).decode('utf_8')
+    finally:
+        os.close(fd)
+
+
+def _read_int(path: os.PathLike) -> int:
+    """
+    Reads a numeric sysfs attribute.
+    :param path: Filepath of the attribute
+    :return: Value of the attribute
+    """
+    return int(_read(path, 32))
+
+
+def get_dmi(keyword: str) -> str:
+    """
+    Gets a DMI string from sysfs, which unlike dmidecode requires neither a subprocess nor root.
+    :param keyword: dmidecode string keyword, e.g. bios-version
+    :return: DMI string
+    """
+    return _read(f'/sys/class/dmi/id/{dmi_attributes[keyword]:s}').strip()
+
+
+@functools.lru_cache(maxsize=1)
 def get_bios_version() -> Optional[str]:
     """
-    Gets the BIOS version from sysfs.
+    Gets the BIOS version from sysfs, once per process.
     :return: BIOS version
     """
     try:
-        with open('/sys/class/dmi/id/bios_version', encoding='utf_8') as f:
-            return f.read().strip()
+        return get_dmi('bios-version')
     except Exception as e:
         logger.warning(e)
         return None
 
 
+@functools.lru_cache(maxsize=1)
+def _find_ac() -> Optional[Path]:
+    """
+    Finds the sysfs directory of the AC power supply, once per process.
+    :return: Path of the AC power supply if found, else None
+    """
+    try:
+        with os.scandir(POWER_SUPPLY_DIR) as it:
+            for entry in it:
+                if entry.name.startswith('AC'):
+                    return Path(entry.path)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _find_bat() -> Optional[Path]:
+    """
+    Finds the sysfs directory of the battery power supply, once per process.
+    :return: Path of the battery power supply if found, else None
+    """
+    try:
+        with os.scandir(POWER_SUPPLY_DIR) as it:
+            for entry in it:
+                if not entry.name.startswith('BAT'):
+                    continue
+                path = Path(entry.path)
+                if Path(path, 'energy_now').exists() or Path(path, 'charge_now').exists():
+                    return path
+    except FileNotFoundError:
+        pass
+    return None
+
+
 def is_on_ac() -> bool:
     """
     Checks if the system is using AC as the power source.
     :return: True if on AC, else False
     """
-    for path in Path('/sys/class/power_supply').rglob('AC*'):
-        with open(Path(path, 'online'), encoding='utf_8') as f:
-            return int(f.read()) == 1
+    path = _find_ac()
+    if path is not None:
+        return _read_int(Path(path, 'online')) == 1
     # Otherwise assume AC
     return True
 
@@ -91,9 +182,8 @@ def get_sleep_mode() -> str:
     Gets the currently active sleep mode, e.g. deep, s2idle
     :return: Sleep mode
     """
-    with open('/sys/power/mem_sleep', encoding='utf_8') as f:
-        out = f.read()
-    return re.findall(r'\[(.*)\]', out)[0]
+    out = _read('/sys/power/mem_sleep')
+    return MEM_SLEEP_RE.search(out).group(1)
 
 
 def get_battery_energy(attribute_suffix: str) -> int:
@@ -101,43 +191,123 @@ def get_battery_energy(attribute_suffix: str) -> int:
     Gets an attribute of the battery power supply class via sysfs.
     :return: Attribute value
     """
-    for path in Path('/sys/class/power_supply').rglob('BAT*'):
-        energy_path = Path(path, f'energy_{attribute_suffix}')
-        if energy_path.exists():
-            with open(energy_path, encoding='utf_8') as f:
-                return int(f.read())
+    path = _find_bat()
+    if path is None:
+        return 0
 
-        charge_path = Path(path, f'charge_{attribute_suffix}')
-        if charge_path.exists():
-            with open(charge_path, encoding='utf_8') as f:
-                charge = int(f.read()) / 1000
-            with open(Path(path, 'voltage_min_design'), encoding='utf_8') as f:
-                voltage = int(f.read()) / 1000
-            return charge * voltage
+    try:
+        return _read_int(Path(path, f'energy_{attribute_suffix}'))
+    except FileNotFoundError:
+        pass
+
+    try:
+        charge = _read_int(Path(path, f'charge_{attribute_suffix}')) / 1000
+    except FileNotFoundError:
+        return 0
+    voltage = _read_int(Path(path, 'voltage_min_design')) / 1000
+    return charge * voltage
+
+
+def _create_history(cur: sqlite3.Cursor) -> None:
+    """
+    Creates the history table, referencing the lookup tables by ID.
+    :param cur: Cursor of the database
+    """
+    cur.execute('CREATE TABLE IF NOT EXISTS history ('
+                'id INTEGER PRIMARY KEY,'
+                'bios_id INTEGER,'
+                'sleep_mode_id INTEGER,'
+                'sleep_action_id INTEGER,'
+                't0 INTEGER, t1 INTEGER,'
+                'e0 INTEGER, e1 INTEGER)')
 
-    return 0
 
-def init(db: str = DATABASE, tmpfile: str = TMPFILE) -> sqlite3.Cursor:
+def _is_legacy_history(cur: sqlite3.Cursor) -> bool:
+    """
+    Checks if the history table stores categorical session attributes as text.
+    :param cur: Cursor of the database
+    :return: True if the history table needs to be migrated, else False
+    """
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(history)')]
+    return 'bios_version' in columns
+
+
+def _migrate_history(cur: sqlite3.Cursor) -> None:
+    """
+    Migrates a history table storing text attributes to the lookup tables in a single transaction.
+    :param cur: Cursor of the database
+    """
+    logger.info('migrating database')
+    with cur.connection:
+        # DDL does not open an implicit transaction, begin one unless earlier DML already did
+        if not cur.connection.in_transaction:
+            cur.execute('BEGIN')
+        for (table, _, column) in lookup_tables:
+            cur.execute(f'INSERT OR IGNORE INTO {table:s} (name) '
+                        f'SELECT DISTINCT {column:s} FROM history WHERE {column:s} IS NOT NULL')
+        cur.execute('DROP INDEX IF EXISTS idx_hist_filter')
+        cur.execute('ALTER TABLE history RENAME TO history_legacy')
+        _create_history(cur)
+        cur.execute('INSERT INTO history (id, bios_id, sleep_mode_id, sleep_action_id, t0, t1, e0, e1) '
+                    'SELECT h.id, b.id, m.id, a.id, h.t0, h.t1, h.e0, h.e1 FROM history_legacy h '
+                    'LEFT JOIN bios_versions b ON b.name = h.bios_version '
+                    'LEFT JOIN sleep_modes m ON m.name = h.sleep_mode '
+                    'LEFT JOIN sleep_actions a ON a.name = h.sleep_action')
+        cur.execute('DROP TABLE history_legacy')
+
+
+def _create_legacy_views(cur: sqlite3.Cursor) -> None:
+    """
+    Creates temporary views over a legacy history table that match the current schema.
+    The text attributes serve as their own IDs, so queries work without writing to the database.
+    :param cur: Cursor of the database
+    """
+    for (table, _, column) in lookup_tables:
+        cur.execute(f'CREATE TEMP VIEW {table:s} AS '
+                    f'SELECT DISTINCT {column:s} AS id, {column:s} AS name FROM main.history')
+    cur.execute('CREATE TEMP VIEW history AS '
+                'SELECT id, bios_version AS bios_id, sleep_mode AS sleep_mode_id, sleep_action AS sleep_action_id,'
+                ' t0, t1, e0, e1 FROM main.history')
+
+
+def init(db: str = DATABASE, tmpfile: str = TMPFILE, readonly: bool = False) -> sqlite3.Cursor:
     """
     Initializes settings and the database.
     :param db: Filepath of the database
     :param tmpfile: Filepath to store sleep session data
+    :param readonly: Open an existing database read-only and without implicit transactions
     :return: Cursor for the database
     """
-    Path(db).parent.mkdir(parents=True, exist_ok=True)
-    Path(tmpfile).parent.mkdir(parents=True, exist_ok=True)
-
     try:
+        if readonly:
+            con = sqlite3.connect(f'file:{db:s}?mode=ro', uri=True, isolation_level=None)
+            cur = con.cursor()
+            if _is_legacy_history(cur):
+                logger.info('database will be migrated on the next sleep session')
+                _create_legacy_views(cur)
+            return cur
+
+        Path(db).parent.mkdir(parents=True, exist_ok=True)
+        Path(tmpfile).parent.mkdir(parents=True, exist_ok=True)
+
         con = sqlite3.connect(db)
         cur = con.cursor()
-        # Initialize the table
-        cur.execute('CREATE TABLE IF NOT EXISTS history ('
-                    'id INTEGER PRIMARY KEY,'
-                    'bios_version TEXT,'
-                    'sleep_mode TEXT,'
-                    'sleep_action TEXT,'
-                    't0 INTEGER, t1 INTEGER,'
-                    'e0 INTEGER, e1 INTEGER)')
+        # One-time revert of databases switched to WAL by an earlier version,
+        # readers of a WAL database need write access to its directory
+        if cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            try:
+                cur.execute('PRAGMA journal_mode=DELETE')
+            except sqlite3.OperationalError:
+                # Retried on the next run if another connection is open
+                logger.debug('unable to revert the journal mode')
+        # Initialize the tables
+        for (table, _, _) in lookup_tables:
+            cur.execute(f'CREATE TABLE IF NOT EXISTS {table:s} (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        if _is_legacy_history(cur):
+            _migrate_history(cur)
+        else:
+            _create_history(cur)
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_hist_filter ON history (bios_id, sleep_mode_id, sleep_action_id)')
         return cur
     except sqlite3.OperationalError:
         logger.critical('unable to open database')
@@ -147,6 +317,7 @@ def init(db: str = DATABASE, tmpfile: str = TMPFILE) -> sqlite3.Cursor:
 def cleanup(cur: sqlite3.Cursor) -> None:
     """
     Cleans up the database connection.
+    Writes of pre and post are already committed at this point.
     :param cur: Cursor for the database.
     """
     con = cur.connection
@@ -154,6 +325,30 @@ def cleanup(cur: sqlite3.Cursor) -> None:
     con.close()
 
 
+def insert_sessions(cur: sqlite3.Cursor, rows: Iterable[Tuple]) -> Optional[int]:
+    """
+    Inserts sleep sessions in bulk, adding new BIOS versions, sleep modes and sleep actions to the lookup tables.
+    The caller owns the transaction, e.g. via "with cur.connection:", so that any number of rows is committed at once.
+    :param cur: Cursor of the database
+    :param rows: Tuples of BIOS version, sleep mode, sleep action, t0 and e0
+    :return: ID of the last inserted session, None if no rows were passed
+    """
+    rows = list(rows)
+    if not rows:
+        return None
+    for (i, (table, _, _)) in enumerate(lookup_tables):
+        names = {row[i] for row in rows if row[i] is not None}
+        cur.executemany(f'INSERT OR IGNORE INTO {table:s} (name) VALUES (?)', ((name,) for name in names))
+    cur.executemany('INSERT INTO history (bios_id, sleep_mode_id, sleep_action_id, t0, e0) VALUES ('
+                    '(SELECT id FROM bios_versions WHERE name = ?),'
+                    '(SELECT id FROM sleep_modes WHERE name = ?),'
+                    '(SELECT id FROM sleep_actions WHERE name = ?),'
+                    '?, ?)',
+                    rows)
+    # lastrowid is not set by executemany
+    return cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+
 def pre(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     """
     Persists time and energy data before entering sleep.
@@ -164,12 +359,13 @@ def pre(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     if is_on_ac():
         return
 
-    cur.execute('INSERT INTO history (bios_version, sleep_mode, sleep_action, t0, e0) VALUES (?, ?, ?, ?, ?)',
-                (get_bios_version(), get_sleep_mode(), args.sleep_action,
-                 round(time.time()), get_battery_energy('now')))
+    # Commit the row only if the session data could be stored as well
+    with cur.connection:
+        cur_id = insert_sessions(cur, [(get_bios_version(), get_sleep_mode(), args.sleep_action,
+                                        round(time.time()), get_battery_energy('now'))])
 
-    with open(TMPFILE, 'w', encoding='utf_8') as f:
-        f.write(str(cur.lastrowid))
+        with open(TMPFILE, 'w', encoding='utf_8') as f:
+            f.write(str(cur_id))
 
 
 def post(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
@@ -178,33 +374,42 @@ def post(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     :param cur: Cursor of the database
     :param args: Namespace of the argument parser
     """
-    if is_on_ac():
+    try:
+        cur_id = int(_read(TMPFILE))
+    except FileNotFoundError:
         return
 
-    if not Path(TMPFILE).exists():
+    if is_on_ac():
         return
 
-    with open(TMPFILE, encoding='utf_8') as f:
-        cur_id = int(f.read())
-
-    cur.execute('UPDATE history SET t1 = ?, e1 = ? WHERE id = ?',
-                (round(time.time()), get_battery_energy('now'), cur_id))
-
-    tmpfile = Path(TMPFILE)
-    if tmpfile.exists():
-        tmpfile.unlink()
+    with cur.connection:
+        cur.execute('UPDATE history SET t1 = ?, e1 = ? WHERE id = ?',
+                    (round(time.time()), get_battery_energy('now'), cur_id))
+    # Keep the session ID unless the update is committed
+    Path(TMPFILE).unlink(missing_ok=True)
 
 
 def plot(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     """
     Plots historical data.
     Results can be filtered by BIOS version and sleep mode, passed via args.
+    The plot is shown in a window, or saved to a file if an output path is passed via args.
     :param cur: Cursor of the database
     :param args: Namespace of the argument parser
     """
-    x_durations = []
-    y_discharge_rates = []
-    # y_energy_losses = []
+    if not args.output and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        logger.error('no display available, use --output to save the plot to a file')
+        sys.exit(1)
+
+    # Imported here as pre and post run on the sleep enter and exit paths and never plot
+    import matplotlib
+    if args.output:
+        # Skip the initialization of a GUI backend
+        matplotlib.use('Agg')
+    import matplotlib.patches as mpatches
+    import matplotlib.pyplot as plt
+    import numpy as np
+
     title = []
 
     if args.bios:
@@ -214,53 +419,36 @@ def plot(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     if args.action:
         title.append(f'action: {args.action}')
 
-    rows = cur.execute('SELECT bios_version, sleep_mode, sleep_action, t0, t1, e0, e1 FROM history').fetchall()
-    for row in rows:
-        # BIOS version
-        if args.bios:
-            if row[0] != args.bios:
-                continue
-        # Sleep mode
-        if args.mode:
-            if row[1] != args.mode:
-                continue
-        # Sleep action
-        if args.action:
-            if row[2] != args.action:
-                continue
-        # Time
-        if row[4] is None:
-            continue
-        td_s = row[4] - row[3]
-        td_h = td_s / 3600
-        if not args.short:
-            if td_s <= DURATION_THRESHOLD_S:
-                continue
-        # Energy
-        ed_w = (row[5] - row[6]) / 1000000
-        if ed_w <= 0:
-            # Filter invalid results
-            continue
-        # Rate
-        rate = ed_w / td_h
-
-        x_durations.append(td_h)
-        y_discharge_rates.append(rate)
-        # y_energy_losses.append(ed_w)
-
-    if not y_discharge_rates:
+    # Filter invalid and short sessions in SQL, only durations and rates are returned
+    where = ['t1 IS NOT NULL', '(t1 - t0) > :threshold', 'e0 > e1']
+    params = {'threshold': 0 if args.short else DURATION_THRESHOLD_S}
+    # Only add plain equality terms for filters that are set, so that idx_hist_filter can be used
+    for (value, (table, column, name)) in zip((args.bios, args.mode, args.action), lookup_tables):
+        if value:
+            where.append(f'{column:s} = (SELECT id FROM {table:s} WHERE name = :{name:s})')
+            params[name] = value
+    rows = cur.execute('SELECT (t1 - t0) / 3600.0 AS td_h,'
+                       ' (e0 - e1) / 1000000.0 / ((t1 - t0) / 3600.0) AS rate'
+                       f' FROM history WHERE {" AND ".join(where):s}',
+                       params).fetchall()
+    if not rows:
         logger.info('nothing to plot')
         return
 
-    mean_discharge_rate = sum(y_discharge_rates) / len(y_discharge_rates)
+    (x_durations, y_discharge_rates) = np.array(rows, dtype=np.float64).T
+
+    mean_discharge_rate = y_discharge_rates.mean()
     est_duration_d = get_battery_energy('full') / 1000000 / mean_discharge_rate / 24
-    total_time_slept_h = sum(x_durations)
+    total_time_slept_h = x_durations.sum()
 
     (fig, ax) = plt.subplots()
 
-    ax.scatter(x_durations, y_discharge_rates, label='discharge rate', marker='o')
-    ax.hlines(y=mean_discharge_rate, xmin=0, xmax=max(x_durations),
-              label=f'mean discharge rate: {mean_discharge_rate:.2f}', linestyle='--')
+    if len(x_durations) > HEXBIN_THRESHOLD:
+        # Bin dense histories instead of drawing every session
+        ax.hexbin(x_durations, y_discharge_rates, gridsize=50, mincnt=1, label='discharge rate')
+    else:
+        ax.plot(x_durations, y_discharge_rates, 'o', markersize=3, label='discharge rate', rasterized=True)
+    ax.axhline(y=mean_discharge_rate, label=f'mean discharge rate: {mean_discharge_rate:.2f}', linestyle='--')
     # ax.scatter(x_durations, y_energy_losses, label=f'energy loss', marker='x')
 
     plt.title(', '.join(title))
@@ -274,7 +462,10 @@ def plot(cur: sqlite3.Cursor, args: argparse.Namespace) -> None:
     ])
     plt.legend(handles=handles, fontsize='x-small')
 
-    plt.show()
+    if args.output:
+        fig.savefig(args.output, dpi=100)
+    else:
+        plt.show()
 
 
 fun_map = {
@@ -289,7 +480,12 @@ def main() -> None:
     args = parse_args()
     logging.basicConfig(format=LOGGING_FORMAT, level=args.loglevel)
 
-    cur = init()
+    readonly = args.main_action == 'plot'
+    if readonly and not Path(DATABASE).exists():
+        logger.info('nothing to plot')
+        return
+
+    cur = init(readonly=readonly)
     fun_map[args.main_action](cur, args)
     cleanup(cur)
 